@@ -3,287 +3,367 @@ import argparse
 import pandas as pd
 import numpy as np
 import pdb
+import multiprocessing
 from pathlib import Path
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from numba import njit, prange
+import pyarrow as pa
+from pyarrow import csv as pacsv
 
+# Non-state columns shared by every shape file
+META_COLUMNS = pd.Index(['sector', 'subsector', 'weather_datetime'])
 
-def interpolate_scaling_factors(scaling_inputs, scenario, subsector_group, target_year, available_years):
+
+@njit(parallel=True, cache=True)
+def _scale_block(block, idx, has_factor, factors):
+    """
+    Compiled inner kernel for scale_profile: sums, rescales and rounds
+    the rows of block listed in idx, in place, parallelized over state
+    columns. Returns the pre-scaling group sums per column
+    """
+    n_states = block.shape[1]
+    num_rows = idx.size
+
+    # Accumulate the sums in float64; sequential float32 accumulation
+    # over 8760 MWh-scale values loses enough precision to shift the
+    # scaling ratios
+    group_sums = np.zeros(n_states, dtype=np.float64)
+    for j in prange(n_states):
+        total = 0.0
+        for k in range(num_rows):
+            total += block[idx[k], j]
+        group_sums[j] = total
+
+        if not has_factor[j]:
+            continue
+        if total != 0:
+            # Normal scaling case
+            ratio = factors[j] / total
+            for k in range(num_rows):
+                i = idx[k]
+                block[i, j] = np.float32(np.rint(block[i, j] * ratio))
+        elif factors[j] > 0 and num_rows > 0:
+            # Zero-to-positive case: distribute evenly across all hours
+            fill = np.float32(np.rint(factors[j] / num_rows))
+            for k in range(num_rows):
+                block[idx[k], j] = fill
+
+    return group_sums
+
+
+# Trigger the JIT compile at import time so the first year file
+# doesn't pay the compilation cost. The tiny block is extracted from a
+# DataFrame exactly the way process_year does it, so the kernel is
+# compiled and exercised with the same array flags production passes
+# it (a plain ndarray here would hide e.g. read-only view errors)
+_scale_block(
+    pd.DataFrame(np.zeros((1, 1), dtype=np.float32)).to_numpy(dtype=np.float32, copy=True),
+    np.zeros(1, dtype=np.int64),
+    np.ones(1, dtype=np.bool_), np.ones(1, dtype=np.float32))
+
+
+def build_factors_by_group(scaling_inputs):
+    """
+    Pivot the scaling inputs into a dict keyed by (scenario, subsector_group)
+    holding (years_array, states_matrix, state_names) so interpolation can
+    work on NumPy arrays instead of re-filtering the DataFrame
+    """
+    state_names = list(scaling_inputs.columns[3:])
+    factors_by_group = {}
+    for (scenario, subsector_group), group_data in scaling_inputs.groupby(['scenario', 'subsector_group']):
+        group_data = group_data.sort_values('year')
+        years_array = group_data['year'].to_numpy()
+        states_matrix = group_data[state_names].to_numpy(dtype=float)
+        factors_by_group[(scenario, subsector_group)] = (years_array, states_matrix, state_names)
+    return factors_by_group
+
+
+def interpolate_scaling_factors(factors_by_group, scenario, subsector_group, target_year):
     """
     Interpolate scaling factors if the target year isn't in the scaling inputs
     """
-    # Filter for the specific scenario and subsector_group
-    scenario_data = scaling_inputs[(scaling_inputs['scenario'] == scenario) & 
-                                  (scaling_inputs['subsector_group'] == subsector_group)]
-    
-    if scenario_data.empty:
+    if (scenario, subsector_group) not in factors_by_group:
         print(f"Warning: No scaling data found for scenario '{scenario}' and subsector group '{subsector_group}'")
         # Return 1.0 for all states (no scaling)
-        return {state: 1.0 for state in scaling_inputs.columns[3:]}
-    
-    # Get the years in the scaling inputs for this scenario/group
-    input_years = sorted(scenario_data['year'].unique())
-    
-    if target_year in input_years:
-        # Direct match - no interpolation needed
-        year_data = scenario_data[scenario_data['year'] == target_year].iloc[0]
-        return {state: year_data[state] for state in scaling_inputs.columns[3:]}
-    
-    # Need to interpolate
-    if target_year < min(input_years):
-        # Target year is before first year in inputs - use earliest year
-        year_data = scenario_data[scenario_data['year'] == min(input_years)].iloc[0]
-        print(f"Warning: Target year {target_year} is before first scaling input year. Using data from {min(input_years)}.")
-        return {state: year_data[state] for state in scaling_inputs.columns[3:]}
-    
-    if target_year > max(input_years):
-        # Target year is after last year in inputs - use latest year
-        year_data = scenario_data[scenario_data['year'] == max(input_years)].iloc[0]
-        print(f"Warning: Target year {target_year} is after last scaling input year. Using data from {max(input_years)}.")
-        return {state: year_data[state] for state in scaling_inputs.columns[3:]}
-    
-    # Interpolate between the two closest years
-    lower_year = max([y for y in input_years if y < target_year])
-    upper_year = min([y for y in input_years if y > target_year])
-    
-    lower_data = scenario_data[scenario_data['year'] == lower_year].iloc[0]
-    upper_data = scenario_data[scenario_data['year'] == upper_year].iloc[0]
-    
-    # Calculate the proportion for interpolation
-    proportion = (target_year - lower_year) / (upper_year - lower_year)
-    
-    # Interpolate for each state
-    scaling_factors = {}
-    for state in scaling_inputs.columns[3:]:
-        scaling_factors[state] = lower_data[state] + proportion * (upper_data[state] - lower_data[state])
-    
-    return scaling_factors
+        state_names = next(iter(factors_by_group.values()))[2] if factors_by_group else []
+        return {state: 1.0 for state in state_names}
+
+    years_array, states_matrix, state_names = factors_by_group[(scenario, subsector_group)]
+
+    if target_year <= years_array[0]:
+        if target_year < years_array[0]:
+            print(f"Warning: Target year {target_year} is before first scaling input year. Using data from {years_array[0]}.")
+        return dict(zip(state_names, states_matrix[0]))
 
+    if target_year >= years_array[-1]:
+        if target_year > years_array[-1]:
+            print(f"Warning: Target year {target_year} is after last scaling input year. Using data from {years_array[-1]}.")
+        return dict(zip(state_names, states_matrix[-1]))
 
-def scale_profile(df, scaling_factors, subsector_group):
+    # Interpolate between the two closest years in one vectorized blend
+    upper = np.searchsorted(years_array, target_year)
+    if years_array[upper] == target_year:
+        return dict(zip(state_names, states_matrix[upper]))
+    lower = upper - 1
+
+    proportion = (target_year - years_array[lower]) / (years_array[upper] - years_array[lower])
+    interpolated = states_matrix[lower] + proportion * (states_matrix[upper] - states_matrix[lower])
+
+    return dict(zip(state_names, interpolated))
+
+
+def load_cached_csv(path):
     """
-    Scale the 8760 timeseries based on scaling factors
-    Handles zero-to-positive scaling case
+    Read a CSV, keeping a feather snapshot next to it so repeat runs
+    skip the text parse when the CSV hasn't changed
     """
-    # Create a copy to avoid modifying the original
-    scaled_df = df.copy()
-    
-    # Extract the subsectors in this group
-    subsectors = [s.strip() for s in subsector_group.split(',')]
-    
-    # Filter rows that belong to the subsector group
-    mask = scaled_df['subsector'].isin(subsectors)
-    
-    # Get state columns (exclude non-state columns)
-    state_columns = [col for col in scaled_df.columns if col not in ['sector', 'subsector', 'weather_datetime']]
-    
-    # For each state, perform scaling
-    for state in state_columns:
-        if state in scaling_factors:
-            scaling_factor = scaling_factors[state]
-            
-            # Handle edge case 1: Initial energy may be zero but we want to scale to positive
-            # Calculate the sum for this subsector group for this state
-            group_sum = scaled_df.loc[mask, state].sum()
-            
-            if group_sum == 0 and scaling_factor > 0:
-                # Zero-to-positive case: distribute evenly across all hours
-                num_rows = mask.sum()
-                if num_rows > 0:
-                    scaled_df.loc[mask, state] = int(scaling_factor / num_rows)
-                    print(f"  Zero-to-positive scaling applied for {state}, subsector_group: {subsector_group}")
-            else:
-                # Normal scaling case
-                if group_sum != 0:
-                    # Calculate ratio needed to achieve target scaling
-                    ratio = scaling_factor / group_sum
-                    scaled_df.loc[mask, state] = (scaled_df.loc[mask, state] * ratio).astype(int)
-    
-    return scaled_df
+    path = str(path)
+    cache = path + '.feather'
+    if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(path):
+        return pd.read_feather(cache)
+    df = pd.read_csv(path)
+    df.to_feather(cache)
+    return df
 
 
-def create_original_energy_summary(unscaled_directory, scaling_inputs, output_dir):
+def read_shape_file(path, state_names):
     """
-    Create a summary file with the original energy values before scaling,
-    in the same format as scaling_inputs_MWh.csv
+    Read a gzipped shape CSV with the multithreaded PyArrow parser,
+    declaring float32 up front for the state columns
     """
-    print("Generating original energy summary file...")
-    
-    # Initialize dataframe to store results
-    result_data = []
-    
-    # Get unique scenarios and subsector groups from scaling inputs
-    scenarios = scaling_inputs['scenario'].unique()
-    
-    for scenario in scenarios:
-        print(f"  Processing scenario: {scenario}")
-        
-        # Get subsector groups for this scenario
-        subsector_groups = scaling_inputs[scaling_inputs['scenario'] == scenario]['subsector_group'].unique()
-        
-        # Path to scenario directory
-        scenario_directory = Path(unscaled_directory) / scenario
-        
-        # Process each year in the scenario directory
-        for year_file in os.listdir(scenario_directory):
-            if year_file == 'summary_shapes.csv' or not year_file.endswith('.csv.gz'):
-                continue
-                
-            year = int(year_file.split('.')[0])
-            print(f"    Processing year: {year}")
-            
-            # Read the unscaled data
-            df = pd.read_csv(os.path.join(scenario_directory, year_file), compression='gzip')
-            
-            # Get state columns (exclude non-state columns)
-            state_columns = [col for col in df.columns if col not in ['sector', 'subsector', 'weather_datetime']]
-            
-            # Process each subsector group
-            for subsector_group in subsector_groups:
-                # Extract the subsectors in this group
-                subsectors = [s.strip() for s in subsector_group.split(',')]
-                
-                # Filter rows that belong to the subsector group
-                mask = df['subsector'].isin(subsectors)
-                
-                # Skip if no rows match this subsector group
-                if not mask.any():
-                    print(f"      Warning: No data found for subsector group '{subsector_group}' in {year}")
-                    # Add a row with zeros for all states
-                    row_data = {
-                        'scenario': scenario,
-                        'subsector_group': subsector_group,
-                        'year': year
-                    }
-                    for state in state_columns:
-                        row_data[state] = 0
-                    result_data.append(row_data)
-                    continue
-                
-                # Calculate sum for each state for this subsector group
-                row_data = {
-                    'scenario': scenario,
-                    'subsector_group': subsector_group,
-                    'year': year
-                }
-                
-                for state in state_columns:
-                    # Get the total energy for this state and subsector group
-                    total_energy = df.loc[mask, state].sum()
-                    row_data[state] = total_energy
-                
-                result_data.append(row_data)
-    
-    # Create dataframe from results
-    result_df = pd.DataFrame(result_data)
-    
-    # Save to CSV
-    output_file = Path(output_dir) / 'original_energy_values.csv'
-    result_df.to_csv(output_file, index=False)
-    print(f"Original energy summary saved to {output_file}")
+    convert_options = pacsv.ConvertOptions(
+        column_types={state: pa.float32() for state in state_names}
+    )
+    table = pacsv.read_csv(str(path), convert_options=convert_options)
+    return table.to_pandas()
+
+
+def scale_profile(state_mat, scaling_factors, mask, subsector_group, state_columns):
+    """
+    Scale the 8760 timeseries based on scaling factors
+    Handles zero-to-positive scaling case
+
+    state_mat is the (rows, states) float32 block holding all state
+    columns for a year file, mask is the precomputed boolean array
+    selecting the rows in this subsector group. Mutates state_mat in
+    place and returns the pre-scaling group sums per state column, or
+    None if the mask selects no rows
+    """
+    # Walk the boolean mask once; the kernel only touches these rows
+    idx = np.flatnonzero(mask)
+    if idx.size == 0:
+        return None
+
+    has_factor = np.array([state in scaling_factors for state in state_columns])
+    factors = np.array([scaling_factors.get(state, 1.0) for state in state_columns], dtype=np.float32)
+
+    # The compiled kernel sums, rescales and rounds in place and
+    # hands back the pre-scaling sums so the edge case can be reported
+    group_sums = _scale_block(state_mat, idx, has_factor, factors)
+
+    # Handle edge case 1: Initial energy may be zero but we want to scale to positive
+    zero_to_positive = has_factor & (group_sums == 0) & (factors > 0)
+    for state in np.array(state_columns)[zero_to_positive]:
+        print(f"  Zero-to-positive scaling applied for {state}, subsector_group: {subsector_group}")
+
+    return group_sums
 
 
 def generate_summary_file(scenario, scenario_data, output_dir):
     """
-    Generate summary_shapes.csv for a scenario by summing across subsectors,
-    with years in columns and states in rows
+    Generate summary_shapes.csv for a scenario, with years in columns
+    and states in rows. scenario_data maps each year to its scaled
+    loads already summed over subsectors
     """
     print(f"  Generating summary_shapes.csv for scenario: {scenario}")
-    
-    # Stack the dataframes and reformat
-    summary_df = pd.concat(scenario_data.values(), keys=scenario_data.keys(), names=['year'])
-    summary_df = summary_df.reset_index('year')
-    del summary_df['subsector']
-    summary_df = summary_df.groupby(['weather_datetime', 'year', 'sector']).sum()
-    summary_df.columns.name = 'state'
-    summary_df = summary_df.stack()
-    summary_df = summary_df.unstack('year')
-    summary_df = summary_df.reorder_levels(['weather_datetime', 'state', 'sector'])
-    summary_df = summary_df.sort_index()
-    
-    # Convert year columns to integers
-    summary_df.columns = [str(int(col)) for col in summary_df.columns]
-    
+
+    years = sorted(scenario_data)
+    first = scenario_data[years[0]]
+    states = sorted(first.columns)
+
+    # The per-year summaries share one sorted (weather_datetime, sector)
+    # index, so the final layout can be built from a single preallocated
+    # block instead of concatenating and pivoting frames
+    datetimes = first.index.levels[0]
+    sectors = first.index.levels[1]
+    assert len(first) == len(datetimes) * len(sectors), \
+        "year summaries must cover every (weather_datetime, sector) pair"
+
+    big = np.empty((len(years), len(first), len(states)), dtype=np.float32)
+    for i, year in enumerate(years):
+        assert scenario_data[year].index.equals(first.index), \
+            f"year {year} summary index does not match year {years[0]}"
+        big[i] = scenario_data[year][states].to_numpy(dtype=np.float32)
+
+    # Rearrange to (weather_datetime, state, sector) rows by year columns
+    big = big.reshape(len(years), len(datetimes), len(sectors), len(states))
+    big = big.transpose(1, 3, 2, 0).reshape(-1, len(years))
+
+    summary_df = pd.DataFrame(
+        big,
+        index=pd.MultiIndex.from_product([datetimes, states, sectors],
+                                         names=['weather_datetime', 'state', 'sector']),
+        columns=[str(int(year)) for year in years],
+    )
+
     summary_df.to_csv(output_dir / 'summary_shapes.csv', index=True)
     print(f"  Created summary_shapes.csv with {len(summary_df)} rows")
 
 
+def process_year(year_file, scenario, scenario_directory, scaled_scenario_dir,
+                 factors_by_group, subsector_groups, state_names, output_format):
+    """
+    Read, scale and save a single year file for a scenario
+
+    Runs in a worker process; returns (year, year_summary,
+    original_rows) where year_summary holds the scaled loads summed
+    over subsectors and original_rows records the pre-scaling energy
+    per subsector group in the same format as scaling_inputs_MWh.csv
+    """
+    year = int(year_file.split('.')[0])
+    print(f"  Processing year: {year}")
+
+    # Read the unscaled data
+    df = read_shape_file(scenario_directory / year_file, state_names)
+
+    # Precompute each group's subsector mask once for this year
+    subsector_col = df['subsector'].to_numpy()
+    masks = {group: np.isin(subsector_col, [s.strip() for s in group.split(',')])
+             for group in subsector_groups}
+
+    # Pull the state columns out into one contiguous float32 block
+    # so scaling works on a single array instead of 50 pandas columns.
+    # copy=True matters: with the columns already float32, to_numpy
+    # would otherwise hand back a read-only copy-on-write view that
+    # the kernel cannot scale in place
+    state_columns = df.columns.difference(META_COLUMNS, sort=False)
+    state_mat = df[state_columns].to_numpy(dtype=np.float32, copy=True)
+
+    # Process each subsector group, recording each group's pre-scaling
+    # energy while the block is hot instead of re-reading the file later
+    original_rows = []
+    for subsector_group in subsector_groups:
+        print(f"    Scaling subsector group: {subsector_group}")
+
+        # Get scaling factors for this scenario/subsector_group/year
+        scaling_factors = interpolate_scaling_factors(
+            factors_by_group, scenario, subsector_group, year
+        )
+
+        # Scale the profile for this subsector group
+        group_sums = scale_profile(state_mat, scaling_factors,
+                                   masks[subsector_group], subsector_group, state_columns)
+
+        row_data = {
+            'scenario': scenario,
+            'subsector_group': subsector_group,
+            'year': year
+        }
+        if group_sums is None:
+            print(f"      Warning: No data found for subsector group '{subsector_group}' in {year}")
+            row_data.update({state: 0 for state in state_columns})
+        else:
+            row_data.update(dict(zip(state_columns, group_sums)))
+        original_rows.append(row_data)
+
+    # Reattach the scaled block before saving
+    df[state_columns] = state_mat
+    scaled_df = df
+
+    # Save scaled data (columnar parquet by default, gzipped CSV
+    # kept as a fallback for older downstream tooling)
+    if output_format == 'csv.gz':
+        output_file = scaled_scenario_dir / year_file
+        scaled_df.to_csv(output_file, compression='gzip', index=False)
+    else:
+        output_file = scaled_scenario_dir / f"{year}.parquet"
+        scaled_df.to_parquet(output_file, compression='zstd', index=False)
+
+    # Keep only the compact per-year summary in memory; the full scaled
+    # frame is already on disk
+    year_summary = (scaled_df
+                    .drop(columns=['subsector'])
+                    .groupby(['weather_datetime', 'sector'])
+                    .sum())
+
+    return year, year_summary, original_rows
+
+
 def main(args):
     # Create output directory structure if it doesn't exist
     scaled_dir = Path(args.output_dir)
     scaled_dir.mkdir(exist_ok=True)
     
     # Read scaling inputs
-    scaling_inputs = pd.read_csv(args.scaling_inputs)
-    
-    # Create original energy summary
-    # create_original_energy_summary(args.input_dir, scaling_inputs, os.path.dirname(args.output_dir))
-    
+    scaling_inputs = load_cached_csv(args.scaling_inputs)
+    state_names = list(scaling_inputs.columns[3:])
+
+    # Pivot the scaling inputs into arrays once, up front
+    factors_by_group = build_factors_by_group(scaling_inputs)
+
     # Dictionary to store data for summary shapes
     summary_data = {}
-    
+
+    # Rows for the original energy summary, collected as a byproduct of
+    # scaling so the input files are only read once
+    original_energy_rows = []
+
     # Process each scenario
     unscaled_directory = Path(args.input_dir)
-    scenarios = [d for d in os.listdir(unscaled_directory) if os.path.isdir(unscaled_directory / d)]
+    scenarios = [entry.name for entry in os.scandir(unscaled_directory) if entry.is_dir()]
     
     for scenario in scenarios:
         print(f"Processing scenario: {scenario}")
         scenario_directory = unscaled_directory / scenario
-        
-        # Get available years in the scenario directory (excluding summary_shapes.csv)
-        available_years = [int(y.split('.')[0]) for y in os.listdir(scenario_directory) 
-                          if y.endswith('.csv.gz') and y != 'summary_shapes.csv']
-        
+
+        # Get unique subsector groups for this scenario from scaling inputs
+        subsector_groups = [g for (s, g) in factors_by_group if s == scenario]
+
         # Create scenario directory in output if it doesn't exist
         scaled_scenario_dir = scaled_dir / scenario
         scaled_scenario_dir.mkdir(exist_ok=True)
         
-        # Store scaled data for summary file generation
+        # Gather the year files for this scenario in one directory pass
+        year_files = [entry.name for entry in os.scandir(scenario_directory)
+                      if entry.is_file() and entry.name.endswith('.csv.gz')
+                      and entry.name != 'summary_shapes.csv']
+
+        # Years are independent until the summary file is generated, so
+        # scale them in parallel across processes
+        worker = partial(process_year,
+                         scenario=scenario,
+                         scenario_directory=scenario_directory,
+                         scaled_scenario_dir=scaled_scenario_dir,
+                         factors_by_group=factors_by_group,
+                         subsector_groups=subsector_groups,
+                         state_names=state_names,
+                         output_format=args.output_format)
+        # Spawned (not forked) workers: the parent already started
+        # numba's threading layer for the warm-up call, and forking a
+        # process with parallel numba running is not safe. Spawning
+        # also re-imports this module in each worker, which warms the
+        # cached kernel there too
         scenario_data = {}
-        
-        # Process each year file
-        for year_file in os.listdir(scenario_directory):
-            if year_file == 'summary_shapes.csv':
-                continue
-                
-            if not year_file.endswith('.csv.gz'):
-                continue
-            
-            year = int(year_file.split('.')[0])
-            print(f"  Processing year: {year}")
-            
-            # Read the unscaled data
-            df = pd.read_csv(os.path.join(scenario_directory, year_file), compression='gzip')
-            
-            # Get unique subsector groups for this scenario from scaling inputs
-            subsector_groups = scaling_inputs[scaling_inputs['scenario'] == scenario]['subsector_group'].unique()
-            
-            # Create a copy for scaled data (start with original)
-            scaled_df = df.copy()
-            
-            # Process each subsector group
-            for subsector_group in subsector_groups:
-                print(f"    Scaling subsector group: {subsector_group}")
-                
-                # Get scaling factors for this scenario/subsector_group/year
-                scaling_factors = interpolate_scaling_factors(
-                    scaling_inputs, scenario, subsector_group, year, available_years
-                )
-                
-                # Scale the profile for this subsector group
-                scaled_df = scale_profile(scaled_df, scaling_factors, subsector_group)
-            
-            # Save scaled data
-            output_file = scaled_scenario_dir / year_file
-            scaled_df.to_csv(output_file, compression='gzip', index=False)
-            
-            # Store in memory for summary file
-            scenario_data[year] = scaled_df
-        
+        with ProcessPoolExecutor(max_workers=os.cpu_count(),
+                                 mp_context=multiprocessing.get_context('spawn')) as executor:
+            for year, year_summary, original_rows in executor.map(worker, year_files):
+                scenario_data[year] = year_summary
+                original_energy_rows.extend(original_rows)
+
         # Store in overall summary dictionary
         summary_data[scenario] = scenario_data
-        
+
         # Generate summary shapes file for this scenario
         generate_summary_file(scenario, scenario_data, scaled_scenario_dir)
-    
+
+    # Save the original energy summary if requested, in the same format
+    # as scaling_inputs_MWh.csv
+    if args.original_energy_summary:
+        output_file = Path(os.path.dirname(args.output_dir)) / 'original_energy_values.csv'
+        pd.DataFrame(original_energy_rows).to_csv(output_file, index=False)
+        print(f"Original energy summary saved to {output_file}")
+
     print("Processing complete!")
 
 
@@ -298,6 +378,11 @@ if __name__ == "__main__":
     parser.add_argument('--scaling-inputs', type=str, 
                         default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scaling_inputs_MWh.csv'),
                         help='CSV file with scaling inputs')
-    
+    parser.add_argument('--output-format', type=str, choices=['parquet', 'csv.gz'],
+                        default='parquet',
+                        help='File format for the scaled shape outputs')
+    parser.add_argument('--original-energy-summary', action='store_true',
+                        help='Also save the pre-scaling energy values to original_energy_values.csv')
+
     args = parser.parse_args()
     main(args)
@@ -12,6 +12,31 @@ import h5py
 import datetime
 import re
 
+def load_cached_csv(path):
+    """Read a CSV through a feather snapshot cached next to it.
+
+    The snapshot is rebuilt whenever the CSV is newer, so warm
+    development runs avoid the text parse entirely.
+
+    Parameters
+    ----------
+    path
+        Path of the CSV file to read
+
+    Returns
+    -------
+    pd.DataFrame
+        Pandas dataframe of the file
+    """
+    path = str(path)
+    cache = path + '.feather'
+    if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(path):
+        return pd.read_feather(cache)
+    df = pd.read_csv(path)
+    df.to_feather(cache)
+    return df
+
+
 def write_profile_to_h5(df, filename, outfolder, compression_opts=4):
     """Writes dataframe to h5py file format used by ReEDS. Used in ReEDS and hourlize
 
@@ -47,19 +72,11 @@ def write_profile_to_h5(df, filename, outfolder, compression_opts=4):
                 f.create_dataset(f'index_{i}', data=indexvals, dtype='S30')
             elif indexvals.name in ['datetime', 'weather_datetime']:
                 # if we have a formatted datetime index that isn't bytes, save as such
-                try:
-                    timeindex = (
-                        indexvals.to_series().apply(datetime.datetime.isoformat).reset_index(drop=True)
-                    )
-                    f.create_dataset(f'index_{i}', data=timeindex.str.encode('utf-8'), dtype='S30')
-                except TypeError:
-                    timeindex = (
-                        pd.to_datetime(indexvals\
-                                       .to_series())\
-                                        .apply(datetime.datetime.isoformat)\
-                                            .reset_index(drop=True)
-                    )
-                    f.create_dataset(f'index_{i}', data=timeindex.str.encode('utf-8'), dtype='S30')
+                timeindex = np.asarray(
+                    pd.DatetimeIndex(pd.to_datetime(indexvals)).strftime('%Y-%m-%dT%H:%M:%S'),
+                    dtype='S30',
+                )
+                f.create_dataset(f'index_{i}', data=timeindex, dtype='S30')
             else:
                 # Other indices can be saved using their data type
                 f.create_dataset(f'index_{i}', data=indexvals, dtype=indexvals.dtype)
@@ -160,8 +177,8 @@ if __name__ == "__main__":
 
     path = Path(f"input_data/")
 
-    load_participation = pd.read_csv(snakemake.input.load_participation)
-    county_to_ba = pd.read_csv(snakemake.input.county_to_ba)
+    load_participation = load_cached_csv(snakemake.input.load_participation)
+    county_to_ba = load_cached_csv(snakemake.input.county_to_ba)
 
     name_to_abbr = {state.name.lower():state.abbr for state in us.STATES_CONTINENTAL}
 
@@ -277,11 +294,12 @@ if __name__ == "__main__":
             # update the index
             subset_copy.index = subset_copy.index.remove_unused_levels().set_levels([year], level=0)
             # print(f"{year} looks like {year_select}")
-            for col in subset_copy.columns:
-                col_total = subset_copy[col].sum()
-                ratio = scenario_annual.at[str(year), col][0] / col_total
-                subset_copy[col] = subset_copy[col] * ratio
-            
+            # rescale all state columns at once with a broadcast multiply
+            block = subset_copy.to_numpy()
+            col_totals = block.sum(axis=0)
+            targets = scenario_annual.loc[str(year)].to_numpy().ravel()
+            subset_copy.iloc[:, :] = block * (targets / col_totals)
+
             frames.append(subset_copy[:8760]) # truncate data
         
         print("Recombining data")
@@ -292,10 +310,22 @@ if __name__ == "__main__":
         combined['maryland'] = combined['district of columbia'] + combined['maryland']
         combined = combined.drop(columns=['district of columbia'])
         combined = combined.rename(columns=name_to_abbr)
-        combined_disagg = pd.DataFrame({row.ba:(combined[row.state].values\
-                *load_participation.loc[load_participation['ba']==row.ba,'factor'].values[0]) 
-        for row in county_to_ba.itertuples()})
-        combined_disagg.index = scenario_interpolated.index
+
+        # Build a (state x ba) weight matrix once and disaggregate the
+        # whole load block with a single matmul. county_to_ba has one
+        # row per county, so the bas must be deduplicated into one
+        # column each
+        factor_map = load_participation.drop_duplicates('ba').set_index('ba')['factor']
+        state_positions = {state: i for i, state in enumerate(combined.columns)}
+        ba_names = list(dict.fromkeys(county_to_ba['ba']))
+        ba_positions = {ba: j for j, ba in enumerate(ba_names)}
+        weights = np.zeros((len(combined.columns), len(ba_names)), dtype=np.float32)
+        for row in county_to_ba.itertuples():
+            weights[state_positions[row.state], ba_positions[row.ba]] = factor_map[row.ba]
+
+        combined_disagg = pd.DataFrame(combined.to_numpy(np.float32) @ weights,
+                                       index=scenario_interpolated.index,
+                                       columns=ba_names)
         scenario_final = pd.concat([df_historical, combined_disagg], axis=0)
 
         print("Saving to h5 file")